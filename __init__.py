@@ -28,6 +28,7 @@ bl_info = {
 
 from . import action_roll_fix_tool
 from . import roll_fix_utilities
+from . import library_action_fix
 
 def register():
     action_roll_fix_tool.register_roll_fix_tool()
@@ -17,7 +17,9 @@
 
 
 import bpy
+from bpy_extras.io_utils import ExportHelper, ImportHelper
 from . import roll_fix_utilities
+from . import library_action_fix
 
 
 # property group for holding action item data
@@ -33,12 +35,22 @@ def p_armature_filter(self, object):
 
 # property group for holding active properties of our plugin
 class ACTIONROLLFIX_Properties(bpy.types.PropertyGroup):
+    reference_source: bpy.props.EnumProperty(
+        name="Reference Source",
+        items=[
+            ('ARMATURE', "Armature", "Use a backup armature object as the reference"),
+            ('SNAPSHOT', "Snapshot", "Use the rest pose snapshot stored on the target armature as the reference"),
+        ],
+        default='ARMATURE',
+        description="Where to read the rest pose from before the roll changes")
     reference_armature_object: bpy.props.PointerProperty(type=bpy.types.Object, poll=p_armature_filter, description="Armature object before roll changes")
     target_armature_object: bpy.props.PointerProperty(type=bpy.types.Object, poll=p_armature_filter, description="Armature object with roll changes and broken animations")
     save_as_copy: bpy.props.BoolProperty(default=True, name="Save As Copy", description="If checked, we'll save the fixed action as a copy")
     replace_existing: bpy.props.BoolProperty(default=True, name="Replace Existing", description="If checked, we'll replace existing actions that already have the name, otherwise we'll just keep adding new copies")
     copy_name_prefix: bpy.props.StringProperty(default="fixed_", description="Suffix to add to the fixed action")
     copy_name_suffix: bpy.props.StringProperty(default="", description="Suffix to add to the fixed action")
+    fix_linked_at_source: bpy.props.BoolProperty(default=False, name="Fix Linked at Source", description="If checked, actions linked from libraries are fixed once in their library file instead of making local copies")
+    library_report_path: bpy.props.StringProperty(default="", subtype='FILE_PATH', description="Json file that maps each shot to the library actions it depends on, leave empty to skip the report")
     action_fix_list: bpy.props.CollectionProperty(type=ACTIONROLLFIX_ActionFixItem)
     action_fix_list_index: bpy.props.IntProperty()
 
@@ -137,29 +149,53 @@ class ACTIONROLLFIX_OT_ExecuteRollFix(bpy.types.Operator):
         plugin_props = context.scene.action_roll_fix
         action_count = len(plugin_props.action_fix_list)
         
-        if not plugin_props.reference_armature_object:
+        if plugin_props.reference_source == 'ARMATURE' and not plugin_props.reference_armature_object:
             self.report({"ERROR"},"Missing Reference Armature")
             return {'CANCELLED'}
         if not plugin_props.target_armature_object:
             self.report({"ERROR"},"Missing Target Armature")
             return {'CANCELLED'}
+        if plugin_props.reference_source == 'ARMATURE':
+            reference_snapshot = roll_fix_utilities.RestPoseSnapshot.from_armature(plugin_props.reference_armature_object)
+        else:
+            try:
+                reference_snapshot = roll_fix_utilities.get_rest_pose_snapshot(plugin_props.target_armature_object)
+            except ValueError as error:
+                self.report({"ERROR"},f"Failed to read the rest pose snapshot: {error}")
+                return {'CANCELLED'}
+            if not reference_snapshot:
+                self.report({"ERROR"},"Target Armature has no rest pose snapshot, capture one before changing the bone rolls")
+                return {'CANCELLED'}
+        target_obj = plugin_props.target_armature_object
+        target_snapshot = roll_fix_utilities.RestPoseSnapshot.from_armature(target_obj)
         if plugin_props.save_as_copy:
             if not plugin_props.copy_name_prefix and not plugin_props.copy_name_suffix and plugin_props.replace_existing:
                 self.report({"ERROR"},"Make Copy with Replace Existing is selected, but no preffix or suffix specified, this would replace the original action, to do that please uncheck \"Make Copy\"")
                 return {'CANCELLED'}
         success_count = 0
+        if plugin_props.fix_linked_at_source:
+            result, success_count = self.fix_library_actions(plugin_props, reference_snapshot, target_snapshot)
+            if not result:
+                self.report({"ERROR"},result.message)
+                return {'CANCELLED'}
         for i in range(action_count):
             action_item = plugin_props.action_fix_list[i]
             print("Converting action " + action_item.name)
             action_id = bpy.data.actions.find(action_item.name)
             if action_id>=0:
                 action = bpy.data.actions[action_id]
+                if action.library and plugin_props.fix_linked_at_source:
+                    continue
                 fix_action = action
                 if plugin_props.save_as_copy:
                     copy_name = plugin_props.copy_name_prefix + action_item.name + plugin_props.copy_name_suffix
                     fix_action = roll_fix_utilities.make_action_copy(action,copy_name,plugin_props.replace_existing)
 
-                result = roll_fix_utilities.apply_action_roll_fix_correction(plugin_props.reference_armature_object,plugin_props.target_armature_object,fix_action)
+                if not target_obj.animation_data:
+                    target_obj.animation_data_create()
+                target_obj.animation_data.action = fix_action
+                slot_identifiers = roll_fix_utilities.get_target_slot_identifiers(fix_action, target_obj)
+                result = roll_fix_utilities.apply_snapshot_roll_fix_correction(reference_snapshot,target_snapshot,fix_action,slot_identifiers)
                 if result:
                     success_count = success_count+1
                     completed_count = i+1
@@ -180,6 +216,130 @@ class ACTIONROLLFIX_OT_ExecuteRollFix(bpy.types.Operator):
 
         return {'FINISHED'}
 
+    #fixes the linked actions from the fix list in their library files and reloads the libraries, returns the result and the number of fixed actions
+    def fix_library_actions(self, plugin_props, reference_snapshot, target_snapshot):
+        actions = []
+        for action_item in plugin_props.action_fix_list:
+            action = bpy.data.actions.get(action_item.name)
+            if action and action.library:
+                actions.append(action)
+        _, library_actions = library_action_fix.group_actions_by_library(actions)
+        fixed_count = 0
+        if not library_actions:
+            return roll_fix_utilities.OpResult(True), fixed_count
+        if not bpy.data.filepath:
+            return roll_fix_utilities.OpResult(False, "Save the file before fixing linked actions at their source"), fixed_count
+        target_obj = plugin_props.target_armature_object
+        #we only read the slots the target already uses, so its active action stays untouched
+        action_slots = {}
+        for action in actions:
+            slot_identifiers = roll_fix_utilities.get_target_slot_identifiers(action, target_obj)
+            if slot_identifiers is not None and not slot_identifiers and roll_fix_utilities.action_has_fcurves(action):
+                return roll_fix_utilities.OpResult(False, f"Action {action.name} has no slot assigned to the target armature, assign it to the target armature with the slot you want fixed"), fixed_count
+            action_slots[action.name] = slot_identifiers
+        libraries = {library_action_fix.get_library_filepath(action.library): action.library for action in actions}
+        shot_dependencies = {bpy.data.filepath: {}}
+        for library_path, library_action_list in library_actions.items():
+            action_names = [action.name for action in library_action_list]
+            shot_dependencies[bpy.data.filepath][library_path] = action_names
+            print("Fixing library actions in " + library_path)
+            errors = library_action_fix.fix_library_in_background(library_path, action_names, reference_snapshot, target_snapshot, action_slots)
+            libraries[library_path].reload()
+            for action_name in action_names:
+                error = errors.get(action_name, "Missing result from the background process")
+                if error:
+                    return roll_fix_utilities.OpResult(False, f"Failed to fix {action_name} in {library_path}: {error}"), fixed_count
+                fixed_count += 1
+                self.report({"INFO"}, "Successfully converted action " + action_name + " in library " + library_path)
+        if plugin_props.library_report_path:
+            library_action_fix.write_dependency_report(bpy.path.abspath(plugin_props.library_report_path), shot_dependencies)
+        return roll_fix_utilities.OpResult(True), fixed_count
+
+# Operator to store a rest pose snapshot on the target armature, so it can be used as the reference instead of a backup rig
+class ACTIONROLLFIX_OT_CaptureRestPoseSnapshot(bpy.types.Operator):
+    bl_idname = "action_roll_fix.capture_rest_pose_snapshot"
+    bl_label = "Capture Rest Pose Snapshot"
+
+    from_reference: bpy.props.BoolProperty(default=False, description="If checked, we'll capture the snapshot from the reference armature instead of the target")
+
+    #the snapshot may be the only record of the rest pose before the roll changes, so we don't overwrite it without asking
+    def invoke(self, context, event):
+        target_obj = context.scene.action_roll_fix.target_armature_object
+        if target_obj and roll_fix_utilities.REST_POSE_SNAPSHOT_PROPERTY in target_obj:
+            return context.window_manager.invoke_confirm(self, event)
+        return self.execute(context)
+
+    def execute(self, context):
+        plugin_props = context.scene.action_roll_fix
+        target_obj = plugin_props.target_armature_object
+        if not target_obj:
+            self.report({"ERROR"},"Missing Target Armature")
+            return {'CANCELLED'}
+        source_obj = target_obj
+        if self.from_reference:
+            source_obj = plugin_props.reference_armature_object
+            if not source_obj:
+                self.report({"ERROR"},"Missing Reference Armature")
+                return {'CANCELLED'}
+        snapshot = roll_fix_utilities.RestPoseSnapshot.from_armature(source_obj)
+        roll_fix_utilities.store_rest_pose_snapshot(target_obj, snapshot)
+        self.report({"INFO"}, f"Stored rest pose snapshot of {source_obj.name} ({len(snapshot.bones)} bones) on {target_obj.name}")
+        bpy.ops.ed.undo_push(message="Captured Rest Pose Snapshot")
+        return {'FINISHED'}
+
+
+# Operator to save the target armature's rest pose snapshot to a sidecar json file
+class ACTIONROLLFIX_OT_ExportRestPoseSnapshot(bpy.types.Operator, ExportHelper):
+    bl_idname = "action_roll_fix.export_rest_pose_snapshot"
+    bl_label = "Save Rest Pose Snapshot"
+
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    def execute(self, context):
+        target_obj = context.scene.action_roll_fix.target_armature_object
+        if not target_obj:
+            self.report({"ERROR"},"Missing Target Armature")
+            return {'CANCELLED'}
+        snapshot_json = target_obj.get(roll_fix_utilities.REST_POSE_SNAPSHOT_PROPERTY)
+        if not snapshot_json:
+            self.report({"ERROR"},"Target Armature has no rest pose snapshot")
+            return {'CANCELLED'}
+        try:
+            with open(self.filepath, "w", encoding="utf-8") as snapshot_file:
+                snapshot_file.write(snapshot_json)
+        except OSError as error:
+            self.report({"ERROR"},f"Failed to save rest pose snapshot: {error}")
+            return {'CANCELLED'}
+        self.report({"INFO"}, "Saved rest pose snapshot to " + self.filepath)
+        return {'FINISHED'}
+
+
+# Operator to load a rest pose snapshot from a sidecar json file onto the target armature
+class ACTIONROLLFIX_OT_ImportRestPoseSnapshot(bpy.types.Operator, ImportHelper):
+    bl_idname = "action_roll_fix.import_rest_pose_snapshot"
+    bl_label = "Load Rest Pose Snapshot"
+
+    filename_ext = ".json"
+    filter_glob: bpy.props.StringProperty(default="*.json", options={'HIDDEN'})
+
+    def execute(self, context):
+        target_obj = context.scene.action_roll_fix.target_armature_object
+        if not target_obj:
+            self.report({"ERROR"},"Missing Target Armature")
+            return {'CANCELLED'}
+        try:
+            with open(self.filepath, "r", encoding="utf-8") as snapshot_file:
+                snapshot = roll_fix_utilities.RestPoseSnapshot.from_json(snapshot_file.read())
+        except (OSError, ValueError) as error:
+            self.report({"ERROR"},f"Failed to load rest pose snapshot: {error}")
+            return {'CANCELLED'}
+        roll_fix_utilities.store_rest_pose_snapshot(target_obj, snapshot)
+        self.report({"INFO"}, f"Loaded rest pose snapshot of {snapshot.armature_name} ({len(snapshot.bones)} bones) onto {target_obj.name}")
+        bpy.ops.ed.undo_push(message="Loaded Rest Pose Snapshot")
+        return {'FINISHED'}
+
+
 class ACTIONROLLFIX_OT_SanitizeBoneRolls(bpy.types.Operator):
     bl_idname = "action_roll_fix.sanitize_rolls"
     bl_label = "Sanitize Constraint Bones"
@@ -263,8 +423,23 @@ class ACTIONROLLFIX_PT_Panel(bpy.types.Panel):
     def draw(self, context):
         layout = self.layout
         params = context.scene.action_roll_fix
-        layout.prop(params, "reference_armature_object",text="Reference")
+        layout.prop(params, "reference_source",expand=True)
+        if params.reference_source == 'ARMATURE':
+            layout.prop(params, "reference_armature_object",text="Reference")
         layout.prop(params, "target_armature_object",text="Target")
+        if params.reference_source == 'ARMATURE':
+            if params.reference_armature_object:
+                layout.operator("action_roll_fix.capture_rest_pose_snapshot", text="Store Reference as Snapshot", icon="ARMATURE_DATA").from_reference = True
+        else:
+            target_obj = params.target_armature_object
+            if target_obj and roll_fix_utilities.REST_POSE_SNAPSHOT_PROPERTY in target_obj:
+                layout.label(text="Target has a rest pose snapshot", icon="CHECKMARK")
+            else:
+                layout.label(text="Capture before changing the rolls", icon="INFO")
+            layout.operator("action_roll_fix.capture_rest_pose_snapshot", text="Capture Snapshot from Target", icon="ARMATURE_DATA").from_reference = False
+            row = layout.row(align=True)
+            row.operator("action_roll_fix.export_rest_pose_snapshot", text="Save Snapshot", icon="EXPORT")
+            row.operator("action_roll_fix.import_rest_pose_snapshot", text="Load Snapshot", icon="IMPORT")
         layout.template_list("ACTIONROLLFIX_UL_ActionFixList", "action_fix_list", params,"action_fix_list", params, "action_fix_list_index")
         layout.operator("action_roll_fix.show_action_fix_list", text="Add Action to Fix List", icon="ADD")
         layout.operator("action_roll_fix.acc_all_actions_to_fix_list", text="Add All Actions to Fix List", icon="ADD")
@@ -274,6 +449,9 @@ class ACTIONROLLFIX_PT_Panel(bpy.types.Panel):
             layout.prop(params,"copy_name_prefix",text="Prefix")
             layout.prop(params,"copy_name_suffix",text="Suffix")
             layout.prop(params,"replace_existing",text="Replace Existing");
+        layout.prop(params,"fix_linked_at_source")
+        if params.fix_linked_at_source:
+            layout.prop(params,"library_report_path",text="Report")
         layout.separator()
         layout.operator("action_roll_fix.execute_roll_fix", text="Fix Selected Actions")
         layout.separator()
@@ -289,6 +467,9 @@ classes = (
     ACTIONROLLFIX_OT_AddAllActionsOperator,
     ACTIONROLLFIX_OT_ShowActionMenu,
     ACTIONROLLFIX_OT_ExecuteRollFix,
+    ACTIONROLLFIX_OT_CaptureRestPoseSnapshot,
+    ACTIONROLLFIX_OT_ExportRestPoseSnapshot,
+    ACTIONROLLFIX_OT_ImportRestPoseSnapshot,
     ACTIONROLLFIX_OT_SanitizeBoneRolls,
     ACTIONROLLFIX_UL_ActionFixList,
     ACTIONROLLFIX_PT_Panel
@@ -0,0 +1,322 @@
+#
+# This file is part of the Mikanim Action Roll Fix plugin
+# https://github.com/spliter88/mikanim_action_roll_fix
+# Copyright (c) 2023 Mikolaj Kuta.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Fixes linked actions once in the library .blend file they come from, instead of making local copies in every shot.
+#
+# Headless batch usage, fixes all linked actions used by the target armature in the given shot files:
+#   blender -b --python library_action_fix.py -- --target-armature RIG [--reference-snapshot snapshot.json] [--report report.json] shot1.blend shot2.blend ...
+# If --reference-snapshot isn't given, the rest pose snapshot stored on the target armature is used.
+
+import bpy
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+if __package__:
+    from . import roll_fix_utilities
+else:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import roll_fix_utilities
+
+#name of the custom property that marks actions that were already fixed, so re-running on other shots doesn't rotate them twice
+ROLL_FIX_APPLIED_PROPERTY = "mikanim_roll_fix_applied"
+#seconds we wait for the background blender process to fix a library
+LIBRARY_FIX_TIMEOUT = 600
+
+
+#returns the absolute path of the library's .blend file
+def get_library_filepath(library):
+    return os.path.normpath(bpy.path.abspath(library.filepath, library=library.parent))
+
+
+#splits the actions into local ones and linked ones grouped by the absolute path of their library
+def group_actions_by_library(actions):
+    local_actions = []
+    library_actions = {}
+    for action in actions:
+        if action.library:
+            library_actions.setdefault(get_library_filepath(action.library), []).append(action)
+        else:
+            local_actions.append(action)
+    return local_actions, library_actions
+
+
+#returns all the actions the armature object uses, both the active action and the ones in its NLA strips
+def get_armature_actions(armature_obj):
+    actions = []
+    anim_data = armature_obj.animation_data
+    if not anim_data:
+        return actions
+    if anim_data.action:
+        actions.append(anim_data.action)
+    for track in anim_data.nla_tracks:
+        for strip in track.strips:
+            if strip.action and strip.action not in actions:
+                actions.append(strip.action)
+    return actions
+
+
+#identifies the correction a reference/target pair applies, built only from the rest rotations of the bones they share,
+#so snapshots of the same rest poses match no matter which rig, shot or run they were captured from
+def get_fix_fingerprint(reference_snapshot, target_snapshot):
+    rest_rotations = []
+    for bone_name in sorted(reference_snapshot.bones):
+        target_bone = target_snapshot.bones.get(bone_name)
+        if not target_bone:
+            continue
+        #adding 0.0 turns -0.0 into 0.0, so it doesn't change the json
+        reference_rotation = [round(value, 5)+0.0 for value in reference_snapshot.bones[bone_name].rest_rotation]
+        target_rotation = [round(value, 5)+0.0 for value in target_bone.rest_rotation]
+        rest_rotations.append([bone_name, reference_rotation, target_rotation])
+    return hashlib.sha1(json.dumps(rest_rotations).encode("utf-8")).hexdigest()
+
+
+#returns the action's fix marker as a dict, None if the action was never fixed.
+#Raises ValueError if the marker can't be read, since we can't tell what was fixed then.
+def get_fix_marker(action):
+    marker_json = action.get(ROLL_FIX_APPLIED_PROPERTY)
+    if not marker_json:
+        return None
+    marker = json.loads(marker_json)
+    if not isinstance(marker, dict) or "fingerprint" not in marker:
+        raise ValueError("malformed fix marker")
+    return marker
+
+
+#returns the slots of the action that were already fixed, True if the whole (legacy) action was
+def get_fixed_slots(marker):
+    if not marker:
+        return set()
+    if marker.get("slots") is None:
+        return True
+    return set(marker["slots"])
+
+
+def mark_fixed_slots(action, fingerprint, fixed_slots):
+    slots = None if fixed_slots is True else sorted(fixed_slots)
+    action[ROLL_FIX_APPLIED_PROPERTY] = json.dumps({"fingerprint": fingerprint, "slots": slots})
+
+
+#fixes the named local actions of the currently open file, returns a dict of action name -> error message (None on success)
+#action_slots maps action names to the identifiers of the slots to fix, actions without an entry have all their slots fixed
+def fix_actions_in_open_file(action_names, reference_snapshot, target_snapshot, action_slots=None):
+    fingerprint = get_fix_fingerprint(reference_snapshot, target_snapshot)
+    results = {}
+    for action_name in action_names:
+        action = bpy.data.actions.get(action_name)
+        if not action or action.library:
+            results[action_name] = f"Could not find local action {action_name} in {bpy.data.filepath}"
+            continue
+        slot_identifiers = action_slots.get(action_name) if action_slots else None
+        if slot_identifiers is not None and not slot_identifiers:
+            if roll_fix_utilities.action_has_fcurves(action):
+                results[action_name] = f"Action {action_name} has no slot assigned to the target armature"
+            else:
+                results[action_name] = None
+            continue
+        try:
+            marker = get_fix_marker(action)
+        except ValueError as error:
+            results[action_name] = f"Action {action_name} has an unreadable {ROLL_FIX_APPLIED_PROPERTY} property: {error}"
+            continue
+        #an action fixed for another rest pose would be rotated twice, so we refuse instead of treating it as unfixed
+        if marker and marker["fingerprint"] != fingerprint:
+            results[action_name] = f"Action {action_name} was already fixed for a different reference or target rest pose"
+            continue
+        fixed_slots = get_fixed_slots(marker)
+        if slot_identifiers is None and fixed_slots and fixed_slots is not True:
+            results[action_name] = f"Action {action_name} already has some of its slots fixed, it can't be fixed as a whole"
+            continue
+        if slot_identifiers is not None and fixed_slots is not True:
+            #only the slots that weren't fixed by an earlier run, so no slot gets rotated twice
+            slot_identifiers = set(slot_identifiers) - fixed_slots
+        if fixed_slots is True or (slot_identifiers is not None and not slot_identifiers):
+            print("Action " + action_name + " was already fixed, skipping")
+            results[action_name] = None
+            continue
+        print("Converting library action " + action_name)
+        result = roll_fix_utilities.apply_snapshot_roll_fix_correction(reference_snapshot, target_snapshot, action, slot_identifiers)
+        if result:
+            mark_fixed_slots(action, fingerprint, True if slot_identifiers is None else fixed_slots | slot_identifiers)
+            results[action_name] = None
+        else:
+            results[action_name] = result.message
+    return results
+
+
+#opens the library file in this blender session, fixes the actions and saves it.
+#A failed action can be left partially rotated, so if any action fails nothing is saved.
+def fix_library_in_process(library_path, action_names, reference_snapshot, target_snapshot, action_slots=None):
+    bpy.ops.wm.open_mainfile(filepath=library_path)
+    results = fix_actions_in_open_file(action_names, reference_snapshot, target_snapshot, action_slots)
+    failed_names = [action_name for action_name, error in results.items() if error]
+    if failed_names:
+        for action_name, error in results.items():
+            if not error:
+                results[action_name] = f"{library_path} was not saved because {', '.join(failed_names)} failed"
+        return results
+    bpy.ops.wm.save_mainfile(filepath=library_path)
+    return results
+
+
+#entry point of the background blender process started by fix_library_in_background()
+def run_library_fix_job(job_path):
+    with open(job_path, "r", encoding="utf-8") as job_file:
+        job = json.load(job_file)
+    reference_snapshot = roll_fix_utilities.RestPoseSnapshot.from_json(job["reference_snapshot"])
+    target_snapshot = roll_fix_utilities.RestPoseSnapshot.from_json(job["target_snapshot"])
+    results = fix_library_in_process(job["library"], job["actions"], reference_snapshot, target_snapshot, job["slots"])
+    with open(job["result"], "w", encoding="utf-8") as result_file:
+        json.dump(results, result_file)
+
+
+#fixes the actions in a separate headless blender process, so the currently open file stays untouched.
+#returns a dict of action name -> error message (None on success)
+def fix_library_in_background(library_path, action_names, reference_snapshot, target_snapshot, action_slots=None, timeout=LIBRARY_FIX_TIMEOUT):
+    with tempfile.TemporaryDirectory() as job_dir:
+        job_path = os.path.join(job_dir, "job.json")
+        result_path = os.path.join(job_dir, "result.json")
+        with open(job_path, "w", encoding="utf-8") as job_file:
+            json.dump({
+                "library": library_path,
+                "actions": action_names,
+                "slots": {action_name: sorted(slot_identifiers) for action_name, slot_identifiers in (action_slots or {}).items() if slot_identifiers is not None},
+                "reference_snapshot": reference_snapshot.to_json(),
+                "target_snapshot": target_snapshot.to_json(),
+                "result": result_path,
+            }, job_file)
+        #we run this file as a script, it works without the add-on package, so it doesn't matter how the add-on was installed
+        command = [bpy.app.binary_path, "--background", "--factory-startup", "--python-exit-code", "1", "--python", os.path.abspath(__file__), "--", "--job", job_path]
+        try:
+            process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        except subprocess.TimeoutExpired:
+            error = f"Background fix of {library_path} timed out after {timeout} seconds"
+            print(error)
+            return {action_name: error for action_name in action_names}
+        if not os.path.exists(result_path):
+            error = f"Background fix of {library_path} failed (exit code {process.returncode})"
+            print(error)
+            print(process.stdout)
+            print(process.stderr)
+            return {action_name: error for action_name in action_names}
+        with open(result_path, "r", encoding="utf-8") as result_file:
+            return json.load(result_file)
+
+
+#merges the shot -> library -> actions dependencies into the json report file
+def write_dependency_report(report_path, shot_dependencies):
+    report = {}
+    if os.path.exists(report_path):
+        with open(report_path, "r", encoding="utf-8") as report_file:
+            report = json.load(report_file)
+    report.update(shot_dependencies)
+    with open(report_path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+
+
+def parse_batch_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(description="Fixes the linked actions used by the target armature in their source library files")
+    parser.add_argument("--target-armature", required=True, help="Name of the armature object with the roll changes")
+    parser.add_argument("--reference-snapshot", help="Rest pose snapshot json from before the roll changes, defaults to the snapshot stored on the target armature")
+    parser.add_argument("--report", help="Json file that maps each shot to the library actions it depends on")
+    parser.add_argument("shots", nargs="+", help="Shot .blend files to scan for linked actions")
+    return parser.parse_args(argv)
+
+
+def run_batch(argv):
+    args = parse_batch_args(argv)
+    file_reference_snapshot = None
+    if args.reference_snapshot:
+        with open(args.reference_snapshot, "r", encoding="utf-8") as snapshot_file:
+            file_reference_snapshot = roll_fix_utilities.RestPoseSnapshot.from_json(snapshot_file.read())
+
+    #we scan all the shots first, so each library is only opened, fixed and saved once
+    library_jobs = {}
+    shot_dependencies = {}
+    failed = False
+    for shot_path in args.shots:
+        shot_path = os.path.normpath(os.path.abspath(shot_path))
+        bpy.ops.wm.open_mainfile(filepath=shot_path)
+        armature_obj = bpy.data.objects.get(args.target_armature)
+        if not armature_obj or armature_obj.type != 'ARMATURE':
+            print(f"Could not find armature {args.target_armature} in {shot_path}")
+            failed = True
+            continue
+        reference_snapshot = file_reference_snapshot
+        if not reference_snapshot:
+            try:
+                reference_snapshot = roll_fix_utilities.get_rest_pose_snapshot(armature_obj)
+            except ValueError as error:
+                print(f"Failed to read the rest pose snapshot of {args.target_armature} in {shot_path}: {error}")
+                failed = True
+                continue
+        if not reference_snapshot:
+            print(f"Armature {args.target_armature} in {shot_path} has no rest pose snapshot, use --reference-snapshot")
+            failed = True
+            continue
+        target_snapshot = roll_fix_utilities.RestPoseSnapshot.from_armature(armature_obj)
+        fingerprint = get_fix_fingerprint(reference_snapshot, target_snapshot)
+        local_actions, library_actions = group_actions_by_library(get_armature_actions(armature_obj))
+        for action in local_actions:
+            print(f"Skipping local action {action.name} in {shot_path}")
+        shot_dependencies[shot_path] = {}
+        for library_path, actions in library_actions.items():
+            action_names = [action.name for action in actions]
+            shot_dependencies[shot_path][library_path] = action_names
+            job = library_jobs.setdefault(library_path, {"actions": [], "slots": {}, "fingerprint": fingerprint, "reference_snapshot": reference_snapshot, "target_snapshot": target_snapshot})
+            #a library can only be fixed for one reference/target pair, otherwise its actions would be rotated twice
+            if job["fingerprint"] != fingerprint:
+                print(f"Shot {shot_path} uses a different reference or target rest pose for {library_path} than the earlier shots, skipping its actions")
+                failed = True
+                continue
+            for action in actions:
+                if action.name not in job["actions"]:
+                    job["actions"].append(action.name)
+                #shots can use different slots of a shared action, we gather them all so the action is still fixed in a single pass
+                slot_identifiers = roll_fix_utilities.get_target_slot_identifiers(action, armature_obj)
+                if slot_identifiers is not None:
+                    job["slots"].setdefault(action.name, set()).update(slot_identifiers)
+
+    for library_path, job in library_jobs.items():
+        results = fix_library_in_process(library_path, job["actions"], job["reference_snapshot"], job["target_snapshot"], job["slots"])
+        for action_name, error in results.items():
+            if error:
+                print(f"Failed to fix {action_name} in {library_path}: {error}")
+                failed = True
+            else:
+                print(f"Fixed {action_name} in {library_path}")
+
+    if args.report:
+        write_dependency_report(args.report, shot_dependencies)
+    return 1 if failed else 0
+
+
+def main(argv):
+    #--job <path> is used by fix_library_in_background() to fix a single library
+    if argv[:1] == ["--job"] and len(argv) == 2:
+        run_library_fix_job(argv[1])
+        return 0
+    return run_batch(argv)
+
+
+if __name__ == "__main__":
+    script_argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else []
+    sys.exit(main(script_argv))
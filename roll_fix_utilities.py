@@ -16,9 +16,14 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import bpy
+import json
 import mathutils
 from math import isclose
 
+#name of the custom property that rest pose snapshots are stored under on the armature object
+REST_POSE_SNAPSHOT_PROPERTY = "mikanim_rest_pose_snapshot"
+REST_POSE_SNAPSHOT_VERSION = 1
+
 class OpResult:
     def __init__(self, success, message=None):
         self.success = success
@@ -49,33 +54,184 @@ def make_action_copy(action, copy_name, replace_existing):
     return copies_action
 
 
-def apply_action_roll_fix_correction(reference_armature_obj, target_armature_obj, target_action):
+#just a small helper class that holds the parts of a bone's rest pose that the roll correction needs
+class BoneRestData:
+    name:str
+    rest_rotation:mathutils.Quaternion
+    rotation_mode:str
+    euler_order:str
+
+    def __init__(self, name, rest_rotation, rotation_mode, euler_order):
+        self.name = name
+        self.rest_rotation = rest_rotation
+        self.rotation_mode = rotation_mode
+        self.euler_order = euler_order
+
+
+# RestPoseSnapshot is a compact stand-in for the reference armature, it only keeps the bone rest rotations and rotation modes.
+# It can be stored as a custom property on the armature object or saved to a json file, so the backup rig isn't needed.
+class RestPoseSnapshot:
+    armature_name:str
+    bones:dict
+
+    def __init__(self, armature_name=""):
+        self.armature_name = armature_name
+        self.bones = {}
+
+    @classmethod
+    def from_armature(cls, armature_obj):
+        snapshot = cls(armature_obj.name)
+        for pose_bone in armature_obj.pose.bones:
+            rest_rotation = pose_bone.bone.matrix_local.to_quaternion()
+            snapshot.bones[pose_bone.name] = BoneRestData(pose_bone.name, rest_rotation, pose_bone.rotation_mode, pose_bone.rotation_euler.order)
+        return snapshot
+
+    def to_json(self):
+        bones = []
+        for bone_data in self.bones.values():
+            bones.append({
+                "name": bone_data.name,
+                "rest_rotation": list(bone_data.rest_rotation),
+                "rotation_mode": bone_data.rotation_mode,
+                "euler_order": bone_data.euler_order,
+            })
+        return json.dumps({"version": REST_POSE_SNAPSHOT_VERSION, "armature": self.armature_name, "bones": bones})
+
+    #raises ValueError if the text isn't a valid snapshot
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        if not isinstance(data, dict) or data.get("version") != REST_POSE_SNAPSHOT_VERSION:
+            raise ValueError("Unsupported rest pose snapshot version")
+        snapshot = cls(data.get("armature", ""))
+        try:
+            for bone in data["bones"]:
+                rest_rotation = mathutils.Quaternion(bone["rest_rotation"])
+                snapshot.bones[bone["name"]] = BoneRestData(bone["name"], rest_rotation, bone["rotation_mode"], bone["euler_order"])
+        except (KeyError, TypeError) as error:
+            raise ValueError(f"Malformed rest pose snapshot: {error}")
+        return snapshot
+
+
+def store_rest_pose_snapshot(armature_obj, snapshot):
+    armature_obj[REST_POSE_SNAPSHOT_PROPERTY] = snapshot.to_json()
+
+
+#returns the snapshot stored on the armature object, or None if it doesn't have one
+def get_rest_pose_snapshot(armature_obj):
+    snapshot_json = armature_obj.get(REST_POSE_SNAPSHOT_PROPERTY)
+    if not snapshot_json:
+        return None
+    return RestPoseSnapshot.from_json(snapshot_json)
+
+
+#reference_snapshot is a RestPoseSnapshot of the armature before the roll changes, see RestPoseSnapshot.from_armature()
+def apply_action_roll_fix_correction(reference_snapshot, target_armature_obj, target_action):
     target_armature_obj.animation_data.action = target_action
+    target_snapshot = RestPoseSnapshot.from_armature(target_armature_obj)
+    slot_identifiers = get_target_slot_identifiers(target_action, target_armature_obj)
+    return apply_snapshot_roll_fix_correction(reference_snapshot, target_snapshot, target_action, slot_identifiers)
+
+
+#same as apply_action_roll_fix_correction() but doesn't need the target armature object, only its snapshot.
+#This lets us fix actions in files that don't contain the rig, like action libraries.
+#slot_identifiers limits which slots of a layered action get fixed, None fixes all of them.
+def apply_snapshot_roll_fix_correction(reference_snapshot, target_snapshot, target_action, slot_identifiers=None):
     print("Called Action roll fix correction")
-    identity_rot = mathutils.Quaternion()
-    for reference_pose_bone in reference_armature_obj.pose.bones:
-        if reference_pose_bone.name not in target_armature_obj.pose.bones:
+    bone_corrections = []
+    for reference_bone in reference_snapshot.bones.values():
+        target_bone = target_snapshot.bones.get(reference_bone.name)
+        if not target_bone:
             continue
-        target_pose_bone = target_armature_obj.pose.bones[reference_pose_bone.name]
-        if target_pose_bone.rotation_mode != reference_pose_bone.rotation_mode:
-            return OpResult(False,f"Reference and Target armatures have incompatible bone rotations on bone \"{reference_pose_bone.name}\", only same-type rotations can be converted")
-        reference_bone = reference_pose_bone.bone
-        target_bone = target_pose_bone.bone
-
-        bone_rot_old = reference_bone.matrix_local.to_quaternion()
-        bone_rot_new = target_bone.matrix_local.to_quaternion()
+        if target_bone.rotation_mode != reference_bone.rotation_mode:
+            return OpResult(False,f"Reference and Target armatures have incompatible bone rotations on bone \"{reference_bone.name}\", only same-type rotations can be converted")
+
+        bone_rot_old = reference_bone.rest_rotation
+        bone_rot_new = target_bone.rest_rotation
         #we skip all the bones that don't need adjustment
         if not all(isclose(rot_old,rot_new) for rot_old,rot_new in zip(bone_rot_old,bone_rot_new)):
-            correction_rot = bone_rot_new.inverted() @ bone_rot_old
-            result = rotate_rotation_fcurves(target_action, target_pose_bone, correction_rot)
+            bone_corrections.append((target_bone, bone_rot_new.inverted() @ bone_rot_old))
+    if not bone_corrections:
+        return OpResult(True)
+
+    if slot_identifiers is not None and not slot_identifiers:
+        #actions without any curves (eg: empty actions) have nothing to fix, so there's no slot to bind either
+        if not action_has_fcurves(target_action):
+            return OpResult(True)
+        return OpResult(False, f"Action {target_action.name} has no slot assigned to the target armature, assign the action to the target armature with the slot you want fixed")
+    channel_bags = decode_action_channel_bags(target_action, slot_identifiers)
+    for channel_bag in channel_bags:
+        for target_bone, correction_rot in bone_corrections:
+            result = rotate_rotation_fcurves(channel_bag, target_bone, correction_rot)
             if not result:
                 return result
-            result = rotate_position_fcurves(target_action, target_pose_bone, correction_rot)
+            result = rotate_position_fcurves(channel_bag, target_bone, correction_rot)
             if not result:
                 return result
     return OpResult(True)
 
 
+#returns the identifiers of the action's slots the armature object uses, either as its active action or in its NLA strips.
+#If the armature doesn't use any of them (eg: the action was keyed on a differently named rig) and the action has a single
+#object slot, we fall back to that slot, like legacy actions did. Otherwise the set is empty, and the action can't be fixed.
+#Returns None for legacy actions that don't have slots.
+def get_target_slot_identifiers(action, armature_obj):
+    if not hasattr(action, "slots"):
+        return None
+    slot_identifiers = set()
+    anim_data = armature_obj.animation_data
+    if anim_data:
+        if anim_data.action == action and anim_data.action_slot:
+            slot_identifiers.add(anim_data.action_slot.identifier)
+        for track in anim_data.nla_tracks:
+            for strip in track.strips:
+                if strip.action == action and strip.action_slot:
+                    slot_identifiers.add(strip.action_slot.identifier)
+    if not slot_identifiers:
+        object_slots = [slot for slot in action.slots if slot.target_id_type in {'OBJECT', 'UNSPECIFIED'}]
+        if len(object_slots) == 1:
+            slot_identifiers.add(object_slots[0].identifier)
+    return slot_identifiers
+
+
+def action_has_fcurves(action):
+    return any(channel_bag.fcurves for channel_bag in decode_action_channel_bags(action))
+
+
+# ChannelBag holds the fcurves of a single action slot (or of a whole legacy action), indexed by data path and array index
+# so the per-bone lookups don't have to scan through all the curves.
+class ChannelBag:
+    name:str
+    fcurves:dict
+
+    def __init__(self, name, fcurves):
+        self.name = name
+        self.fcurves = {}
+        for fcurve in fcurves:
+            self.fcurves[(fcurve.data_path, fcurve.array_index)] = fcurve
+
+
+#reads the action's curves in a single pass over its layers and strips, returns one ChannelBag per slot in slot_identifiers (or per slot if it's None)
+def decode_action_channel_bags(action, slot_identifiers=None):
+    #legacy actions from before Blender 4.4 keep all their curves directly on the action.
+    #Empty actions have no layers and count as legacy, but Blender 5.0 doesn't have action.fcurves anymore.
+    if not hasattr(action, "layers") or len(action.layers) == 0:
+        if hasattr(action, "fcurves"):
+            return [ChannelBag(action.name, action.fcurves)]
+        return []
+    channel_bags = []
+    for layer in action.layers:
+        for strip in layer.strips:
+            if strip.type != 'KEYFRAME':
+                continue
+            for channelbag in strip.channelbags:
+                slot = channelbag.slot
+                if slot_identifiers is not None and slot.identifier not in slot_identifiers:
+                    continue
+                channel_bags.append(ChannelBag(f"{action.name} (slot {slot.identifier})", channelbag.fcurves))
+    return channel_bags
+
+
 def rotate_keyframe(inv_rotation, rotation, src_fcurves, dst_fcurves, keyframeIdx):
     #note: both source and destination curves can be the same curve object
     src_keys = [None,None,None,None]
@@ -114,16 +270,13 @@ def rotate_keyframe(inv_rotation, rotation, src_fcurves, dst_fcurves, keyframeId
     return OpResult(True)
 
 
-#retrieves curves from action and stores them in an existing list
-def gather_fcurves(action, data_path, max_index, out_fcurves):
-    for fcurve in action.fcurves:
-        if fcurve.data_path == data_path:
-            if fcurve.array_index>=max_index:
-                break
-            out_fcurves[fcurve.array_index] = fcurve
+#retrieves curves from the channel bag and stores them in an existing list
+def gather_fcurves(channel_bag, data_path, max_index, out_fcurves):
     curve_count = 0
-    for fcurve in out_fcurves:
+    for array_index in range(max_index):
+        fcurve = channel_bag.fcurves.get((data_path, array_index))
         if fcurve:
+            out_fcurves[array_index] = fcurve
             curve_count+=1
     return curve_count
 
@@ -162,25 +315,30 @@ class VectorKey:
         self.handle_left = mathutils.Vector()
         self.handle_right = mathutils.Vector()
 
-# RotationCurveDesc's descendants provide functionality for writing to and from fcurves of particular types.
+# CurveDesc's descendants describe the fcurves of a single bone channel, bone_data is a BoneRestData
 class CurveDesc:
     data_path: str
     param_count: int
 
-    def __init__(self, pose_bone):
-        self.data_path = pose_bone.path_from_id(self.get_param_id())
-        self.param_count = len(getattr(pose_bone,self.get_param_id()))
+    def __init__(self, bone_data):
+        self.data_path = f'pose.bones["{bpy.utils.escape_identifier(bone_data.name)}"].{self.get_param_id()}'
+        self.param_count = self.get_param_count()
 
     def get_param_id(self):
-        raise NotImplementedError("Subclasses must implement the get_keyframe_count() method")
+        raise NotImplementedError("Subclasses must implement the get_param_id() method")
         return ""
 
+    def get_param_count(self):
+        raise NotImplementedError("Subclasses must implement the get_param_count() method")
+        return 0
+
 # RotationCurveDesc's descendants provide functionality for writing to and from fcurves of particular types.
+# with_handles=False only reads/writes the key values, for keys whose handles don't need converting
 class RotationCurveDesc(CurveDesc):
-    def set_quat_key_from_keys(self, dst_quat_key, src_keys):
+    def set_quat_key_from_keys(self, dst_quat_key, src_keys, with_handles=True):
         raise NotImplementedError("Subclasses must implement the set_quat_key_from_keys() method")
 
-    def set_keys_from_quat_key(self, dst_keys, src_quat_key):
+    def set_keys_from_quat_key(self, dst_keys, src_quat_key, with_handles=True):
         raise NotImplementedError("Subclasses must implement the set_keys_from_quat_key() method")
 
 
@@ -189,52 +347,65 @@ class QuaternionRotationCurveDesc(RotationCurveDesc):
     def get_param_id(self):
         return "rotation_quaternion"
 
-    def set_quat_key_from_keys(self, dst_quat_key, src_keys):
+    def get_param_count(self):
+        return 4
+
+    def set_quat_key_from_keys(self, dst_quat_key, src_keys, with_handles=True):
         assert len(src_keys) == 4 
         for i in range(4):
             dst_quat_key.value[i] = src_keys[i].co.y
-            dst_quat_key.handle_left[i]= src_keys[i].handle_left.y
-            dst_quat_key.handle_right[i] = src_keys[i].handle_right.y
+            if with_handles:
+                dst_quat_key.handle_left[i]= src_keys[i].handle_left.y
+                dst_quat_key.handle_right[i] = src_keys[i].handle_right.y
 
-    def set_keys_from_quat_key(self, dst_keys, src_quat_key):
+    def set_keys_from_quat_key(self, dst_keys, src_quat_key, with_handles=True):
         assert len(dst_keys) == 4 
         for i in range(4):
             dst_keys[i].co.y = src_quat_key.value[i]
-            dst_keys[i].handle_left.y = src_quat_key.handle_left[i]
-            dst_keys[i].handle_right.y = src_quat_key.handle_right[i]
+            if with_handles:
+                dst_keys[i].handle_left.y = src_quat_key.handle_left[i]
+                dst_keys[i].handle_right.y = src_quat_key.handle_right[i]
 
 
 # EulerRotationCurveDesc is used to help converting euler fcurves
 class EulerRotationCurveDesc(RotationCurveDesc):
     euler_order:str
 
-    def __init__(self, pose_bone):
-        super().__init__(pose_bone)
-        self.euler_order = pose_bone.rotation_euler.order
+    def __init__(self, bone_data):
+        super().__init__(bone_data)
+        self.euler_order = bone_data.euler_order
 
     def get_param_id(self):
         return "rotation_euler"
 
-    def set_quat_key_from_keys(self, dst_quat_key, src_keys):
+    def get_param_count(self):
+        return 3
+
+    def set_quat_key_from_keys(self, dst_quat_key, src_keys, with_handles=True):
         assert len(src_keys) == 3
         euler_val =          mathutils.Euler((src_keys[0].co.y,           src_keys[1].co.y,           src_keys[2].co.y),           self.euler_order)
+        dst_quat_key.value = euler_val.to_quaternion()
+        if not with_handles:
+            return
         euler_handle_left =  mathutils.Euler((src_keys[0].handle_left.y,  src_keys[1].handle_left.y,  src_keys[2].handle_left.y),  self.euler_order)
         euler_handle_right = mathutils.Euler((src_keys[0].handle_right.y, src_keys[1].handle_right.y, src_keys[2].handle_right.y), self.euler_order)
-        dst_quat_key.value = euler_val.to_quaternion()
         dst_quat_key.handle_left= euler_handle_left.to_quaternion()
         dst_quat_key.handle_right = euler_handle_right.to_quaternion()
 
-    def set_keys_from_quat_key(self, dst_keys, src_quat_key):
+    def set_keys_from_quat_key(self, dst_keys, src_quat_key, with_handles=True):
         assert len(dst_keys) == 3
         #note: we re-create the euler keys because we need them for the compatibility calculations
         old_euler_val =          mathutils.Euler((dst_keys[0].co.y,           dst_keys[1].co.y,           dst_keys[2].co.y),           self.euler_order)
+        euler_val =          src_quat_key.value.to_euler(       self.euler_order,old_euler_val)
+        for i in range(3):
+            dst_keys[i].co.y = euler_val[i]
+        if not with_handles:
+            return
         old_euler_handle_left =  mathutils.Euler((dst_keys[0].handle_left.y,  dst_keys[1].handle_left.y,  dst_keys[2].handle_left.y),  self.euler_order)
         old_euler_handle_right = mathutils.Euler((dst_keys[0].handle_right.y, dst_keys[1].handle_right.y, dst_keys[2].handle_right.y), self.euler_order)
-        euler_val =          src_quat_key.value.to_euler(       self.euler_order,old_euler_val)
         euler_handle_left =  src_quat_key.handle_left.to_euler( self.euler_order,old_euler_handle_left)
         euler_handle_right = src_quat_key.handle_right.to_euler(self.euler_order,old_euler_handle_right)
         for i in range(3):
-            dst_keys[i].co.y = euler_val[i]
             dst_keys[i].handle_left.y = euler_handle_left[i]
             dst_keys[i].handle_right.y = euler_handle_right[i]
 
@@ -244,22 +415,29 @@ class AxisAngleCurveDesc(RotationCurveDesc):
     def get_param_id(self):
         return "rotation_axis_angle"
 
-    def set_quat_key_from_keys(self, dst_quat_key, src_keys):
+    def get_param_count(self):
+        return 4
+
+    def set_quat_key_from_keys(self, dst_quat_key, src_keys, with_handles=True):
         assert len(src_keys) == 4 
         dst_quat_key.value =        mathutils.Quaternion((src_keys[1].co.y,           src_keys[2].co.y,           src_keys[3].co.y),           src_keys[0].co.y)
-        dst_quat_key.handle_left=   mathutils.Quaternion((src_keys[1].handle_left.y,  src_keys[2].handle_left.y,  src_keys[3].handle_left.y),  src_keys[0].handle_left.y)
-        dst_quat_key.handle_right = mathutils.Quaternion((src_keys[1].handle_right.y, src_keys[2].handle_right.y, src_keys[3].handle_right.y), src_keys[0].handle_right.y)
+        if with_handles:
+            dst_quat_key.handle_left=   mathutils.Quaternion((src_keys[1].handle_left.y,  src_keys[2].handle_left.y,  src_keys[3].handle_left.y),  src_keys[0].handle_left.y)
+            dst_quat_key.handle_right = mathutils.Quaternion((src_keys[1].handle_right.y, src_keys[2].handle_right.y, src_keys[3].handle_right.y), src_keys[0].handle_right.y)
 
-    def set_keys_from_quat_key(self, dst_keys, src_quat_key):
+    def set_keys_from_quat_key(self, dst_keys, src_quat_key, with_handles=True):
         assert len(dst_keys) == 4 
         aangle_val = src_quat_key.value.to_axis_angle()
+        for i in range(3):
+            dst_keys[i+1].co.y = aangle_val[0][i]
+        dst_keys[0].co.y = aangle_val[1]
+        if not with_handles:
+            return
         aangle_handle_left = src_quat_key.handle_left.to_axis_angle()
         aangle_handle_right = src_quat_key.handle_right.to_axis_angle()
         for i in range(3):
-            dst_keys[i+1].co.y = aangle_val[0][i]
             dst_keys[i+1].handle_left.y = aangle_handle_left[0][i]
             dst_keys[i+1].handle_right.y = aangle_handle_right[0][i]
-        dst_keys[0].co.y = aangle_val[1]
         dst_keys[0].handle_left.y = aangle_handle_left[1]
         dst_keys[0].handle_right.y = aangle_handle_right[1]
 
@@ -269,28 +447,69 @@ class PositionCurveDesc(CurveDesc):
     def get_param_id(self):
         return "location"
 
-    def set_vec_key_from_keys(self, dst_quat_key, src_keys):
+    def get_param_count(self):
+        return 3
+
+    def set_vec_key_from_keys(self, dst_quat_key, src_keys, with_handles=True):
         assert len(src_keys) == self.param_count
         for i in range(self.param_count):
             dst_quat_key.value[i] = src_keys[i].co.y
-            dst_quat_key.handle_left[i]= src_keys[i].handle_left.y
-            dst_quat_key.handle_right[i] = src_keys[i].handle_right.y
+            if with_handles:
+                dst_quat_key.handle_left[i]= src_keys[i].handle_left.y
+                dst_quat_key.handle_right[i] = src_keys[i].handle_right.y
 
-    def set_keys_from_vec_key(self, dst_keys, src_quat_key):
+    def set_keys_from_vec_key(self, dst_keys, src_quat_key, with_handles=True):
         assert len(dst_keys) == self.param_count
         for i in range(self.param_count):
             dst_keys[i].co.y = src_quat_key.value[i]
-            dst_keys[i].handle_left.y = src_quat_key.handle_left[i]
-            dst_keys[i].handle_right.y = src_quat_key.handle_right[i]
-
+            if with_handles:
+                dst_keys[i].handle_left.y = src_quat_key.handle_left[i]
+                dst_keys[i].handle_right.y = src_quat_key.handle_right[i]
+
+
+#returns the curve descriptor that matches the bone's rotation_mode
+def get_curve_desc_for_bone(bone_data):
+    if bone_data.rotation_mode=='QUATERNION':
+        return QuaternionRotationCurveDesc(bone_data)
+    if bone_data.rotation_mode=='AXIS_ANGLE':
+        return AxisAngleCurveDesc(bone_data)
+    return EulerRotationCurveDesc(bone_data)
+
+
+#handle types that fcurve.update() recalculates, so we don't need to convert them ourselves
+AUTO_HANDLE_TYPES = {'AUTO', 'AUTO_CLAMPED', 'VECTOR'}
+
+#returns a list that says for every key whether its handles affect the curve's evaluation and aren't recalculated automatically.
+#A key's right handle only matters if it starts a bezier segment, and its left handle only if the previous key does,
+#the end keys' outer handles only matter for bezier keys with linear extrapolation.
+def get_keys_needing_handles(fcurves, key_count):
+    keys_needing_handles = [False]*key_count
+    for fcurve in fcurves:
+        keyframe_points = fcurve.keyframe_points
+        linear_extrapolation = fcurve.extrapolation == 'LINEAR'
+        prev_is_bezier = False
+        for key_index in range(key_count):
+            key = keyframe_points[key_index]
+            is_bezier = key.interpolation == 'BEZIER'
+            uses_left = prev_is_bezier or (key_index == 0 and is_bezier and linear_extrapolation)
+            uses_right = is_bezier and (key_index < key_count-1 or linear_extrapolation)
+            if (uses_left and key.handle_left_type not in AUTO_HANDLE_TYPES) or (uses_right and key.handle_right_type not in AUTO_HANDLE_TYPES):
+                keys_needing_handles[key_index] = True
+            prev_is_bezier = is_bezier
+    return keys_needing_handles
+
+
+#checks if every curve holds a single value, ie: all of its keys and handles are at the same height
+def are_fcurves_constant(fcurves, key_count):
+    coords = [0.0]*(key_count*2)
+    for fcurve in fcurves:
+        constant_value = fcurve.keyframe_points[0].co.y
+        for prop_name in ("co", "handle_left", "handle_right"):
+            fcurve.keyframe_points.foreach_get(prop_name, coords)
+            if not all(isclose(value, constant_value) for value in coords[1::2]):
+                return False
+    return True
 
-#returns the curve descriptor that matches the pose_bone's rotation_mode
-def get_curve_desc_for_bone(pose_bone):
-    if pose_bone.rotation_mode=='QUATERNION':
-        return QuaternionRotationCurveDesc(pose_bone)
-    if pose_bone.rotation_mode=='AXIS_ANGLE':
-        return AxisAngleCurveDesc(pose_bone)
-    return EulerRotationCurveDesc(pose_bone)
 
 #this just holds the curves
 class CurveCollection:
@@ -300,89 +519,152 @@ class CurveCollection:
     is_valid: bool
     error_message:str
     curve_desc:CurveDesc
+    is_constant: bool
+    keys_needing_handles:[]
 
-    def __init__(self, action, curve_desc):
+    def __init__(self, channel_bag, curve_desc):
         self.is_valid = False
         self.curve_desc = curve_desc
         self.fcurves = [None]*curve_desc.param_count
-        self.curve_count = gather_fcurves(action, curve_desc.data_path, curve_desc.param_count, self.fcurves)
+        self.curve_count = gather_fcurves(channel_bag, curve_desc.data_path, curve_desc.param_count, self.fcurves)
         self.error_message = None
         self.key_count = 0
+        self.is_constant = True
+        self.keys_needing_handles = []
         if self.curve_count==0:
             self.is_valid = True
             return
         if self.curve_count!=curve_desc.param_count:
-            self.error_message = f"Action {action.name} cannot be converted: it has the wrong number of curves for {curve_desc.data_path} (has {self.curve_count} but should have {curve_desc.param_count})"
+            self.error_message = f"Action {channel_bag.name} cannot be converted: it has the wrong number of curves for {curve_desc.data_path} (has {self.curve_count} but should have {curve_desc.param_count})"
             return
         for i in range(1, self.curve_count):
             result = check_fcurve_keyframe_compatibility(self.fcurves[0], self.fcurves[i])
             if not result:
-                self.error_message = f"Action {action.name} cannot be converted: {result.message}"
+                self.error_message = f"Action {channel_bag.name} cannot be converted: {result.message}"
                 return
         self.key_count = len(self.fcurves[0].keyframe_points)
+        if self.key_count > 0:
+            self.is_constant = are_fcurves_constant(self.fcurves, self.key_count)
+            if not self.is_constant:
+                self.keys_needing_handles = get_keys_needing_handles(self.fcurves, self.key_count)
         self.is_valid = True
 
     def __bool__(self):
         return self.is_valid
 
+    def get_key_values(self, key_index):
+        return [fcurve.keyframe_points[key_index].co.y for fcurve in self.fcurves]
+
+    #copies the first key's value to every key and handle, used to write constant curves without converting each key
+    def fill_from_first_key(self):
+        for fcurve in self.fcurves:
+            keyframe_points = fcurve.keyframe_points
+            value = keyframe_points[0].co.y
+            for key_index in range(self.key_count):
+                key = keyframe_points[key_index]
+                key.co.y = value
+                key.handle_left.y = value
+                key.handle_right.y = value
+
+    #recalculates the automatic handles, once per curve after all the keys have been written
+    def update_fcurves(self):
+        for fcurve in self.fcurves:
+            fcurve.update()
+
 #helper func for converting rotation curves
-def set_quat_key_from_fcurve(curve_collection, key_index, dst_quat_key):
+def set_quat_key_from_fcurve(curve_collection, key_index, dst_quat_key, with_handles=True):
     keys=[]
     for fcurve in curve_collection.fcurves:
         keys.append(fcurve.keyframe_points[key_index])
-    return curve_collection.curve_desc.set_quat_key_from_keys(dst_quat_key, keys)
+    return curve_collection.curve_desc.set_quat_key_from_keys(dst_quat_key, keys, with_handles)
 
-def set_fcurve_from_quat_key(curve_collection, key_index, src_quat_key):
+def set_fcurve_from_quat_key(curve_collection, key_index, src_quat_key, with_handles=True):
     keys=[]
     for fcurve in curve_collection.fcurves:
         keys.append(fcurve.keyframe_points[key_index])
-    return curve_collection.curve_desc.set_keys_from_quat_key(keys, src_quat_key)
+    return curve_collection.curve_desc.set_keys_from_quat_key(keys, src_quat_key, with_handles)
 
 #helper func for converting position curves
-def set_vec_key_from_fcurve(curve_collection, key_index, dst_quat_key):
+def set_vec_key_from_fcurve(curve_collection, key_index, dst_quat_key, with_handles=True):
     keys=[]
     for fcurve in curve_collection.fcurves:
         keys.append(fcurve.keyframe_points[key_index])
-    return curve_collection.curve_desc.set_vec_key_from_keys(dst_quat_key, keys)
+    return curve_collection.curve_desc.set_vec_key_from_keys(dst_quat_key, keys, with_handles)
 
-def set_fcurve_from_vec_key(curve_collection, key_index, src_quat_key):
+def set_fcurve_from_vec_key(curve_collection, key_index, src_quat_key, with_handles=True):
     keys=[]
     for fcurve in curve_collection.fcurves:
         keys.append(fcurve.keyframe_points[key_index])
-    return curve_collection.curve_desc.set_keys_from_vec_key(keys, src_quat_key)
+    return curve_collection.curve_desc.set_keys_from_vec_key(keys, src_quat_key, with_handles)
+
 
+#constant curves only need their first key converted, the rest is copied over, and if the value doesn't change (eg: zero location) nothing is written
+def write_constant_fcurves(curve_collection, set_first_key):
+    old_values = curve_collection.get_key_values(0)
+    set_first_key()
+    new_values = curve_collection.get_key_values(0)
+    if all(isclose(old_value, new_value, abs_tol=1e-9) for old_value, new_value in zip(old_values, new_values)):
+        return
+    curve_collection.fill_from_first_key()
 
-def rotate_rotation_fcurves(action, pose_bone, rotation):
-    curve_desc = get_curve_desc_for_bone(pose_bone)
-    curve_collection = CurveCollection(action,curve_desc)
+
+def rotate_rotation_fcurves(channel_bag, bone_data, rotation):
+    curve_desc = get_curve_desc_for_bone(bone_data)
+    curve_collection = CurveCollection(channel_bag,curve_desc)
     if not curve_collection.is_valid:
-        return OpResult(False, f"Failed to convert action {action.name}, reason: {curve_collection.error_message}")
+        return OpResult(False, f"Failed to convert action {channel_bag.name}, reason: {curve_collection.error_message}")
+    if curve_collection.key_count==0:
+        return OpResult(True)
     
     inv_rotation = rotation.inverted()
 
     quat_key = QuatKey()
+    if curve_collection.is_constant:
+        def set_first_key():
+            set_quat_key_from_fcurve(curve_collection, 0, quat_key, False)
+            quat_key.value = rotation @ quat_key.value @ inv_rotation
+            set_fcurve_from_quat_key(curve_collection, 0, quat_key, False)
+        write_constant_fcurves(curve_collection, set_first_key)
+        return OpResult(True)
+
     for key_index in range(curve_collection.key_count):
-        set_quat_key_from_fcurve(curve_collection, key_index, quat_key)
+        with_handles = curve_collection.keys_needing_handles[key_index]
+        set_quat_key_from_fcurve(curve_collection, key_index, quat_key, with_handles)
         quat_key.value = rotation @ quat_key.value @ inv_rotation
-        quat_key.handle_left = rotation @ quat_key.handle_left @ inv_rotation
-        quat_key.handle_right = rotation @ quat_key.handle_right @ inv_rotation
-        set_fcurve_from_quat_key(curve_collection, key_index, quat_key)
+        if with_handles:
+            quat_key.handle_left = rotation @ quat_key.handle_left @ inv_rotation
+            quat_key.handle_right = rotation @ quat_key.handle_right @ inv_rotation
+        set_fcurve_from_quat_key(curve_collection, key_index, quat_key, with_handles)
+    curve_collection.update_fcurves()
     
     return OpResult(True)
 
 
-def rotate_position_fcurves(action, pose_bone, rotation):
-    curve_desc = PositionCurveDesc(pose_bone)
-    curve_collection = CurveCollection(action,curve_desc)
+def rotate_position_fcurves(channel_bag, bone_data, rotation):
+    curve_desc = PositionCurveDesc(bone_data)
+    curve_collection = CurveCollection(channel_bag,curve_desc)
     if not curve_collection.is_valid:
-        return OpResult(False, f"Failed to convert action {action.name}, reason: {curve_collection.error_message}")
+        return OpResult(False, f"Failed to convert action {channel_bag.name}, reason: {curve_collection.error_message}")
+    if curve_collection.key_count==0:
+        return OpResult(True)
     
     pos_key = VectorKey()
+    if curve_collection.is_constant:
+        def set_first_key():
+            set_vec_key_from_fcurve(curve_collection, 0, pos_key, False)
+            pos_key.value = rotation @ pos_key.value
+            set_fcurve_from_vec_key(curve_collection, 0, pos_key, False)
+        write_constant_fcurves(curve_collection, set_first_key)
+        return OpResult(True)
+
     for key_index in range(curve_collection.key_count):
-        set_vec_key_from_fcurve(curve_collection, key_index,pos_key)
+        with_handles = curve_collection.keys_needing_handles[key_index]
+        set_vec_key_from_fcurve(curve_collection, key_index, pos_key, with_handles)
         pos_key.value = rotation @ pos_key.value
-        pos_key.handle_left = rotation @ pos_key.handle_left
-        pos_key.handle_right = rotation @ pos_key.handle_right
-        set_fcurve_from_vec_key(curve_collection, key_index,pos_key)
+        if with_handles:
+            pos_key.handle_left = rotation @ pos_key.handle_left
+            pos_key.handle_right = rotation @ pos_key.handle_right
+        set_fcurve_from_vec_key(curve_collection, key_index, pos_key, with_handles)
+    curve_collection.update_fcurves()
     
-    return OpResult(True)
\ No newline at end of file
+    return OpResult(True)